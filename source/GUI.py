@@ -7,7 +7,6 @@ from PIL import ImageTk
 import rawpy
 import threading
 import numpy as np 
-import cv2
 import multiprocessing
 from typing import Literal
 
@@ -530,12 +529,11 @@ class GUI:
     
     def load_IMG(self, event=None):
         # Loading new image into GUI, loads other images in background
-        def load_async(photo, i):
-            # Threading function to load photo in background
-            # photo: RawProcessing object
-            # i: the index of the photo in self.photos
-            photo.load()
-            self.in_progress.remove(i)
+        def load_async(indices):
+            # Threading function to load photos in background
+            # indices: the indices of the photos in self.photos
+            photo_indices = {id(self.photos[i]): i for i in indices}
+            RawProcessing.load_many([self.photos[i] for i in indices], callback=lambda photo: self.in_progress.discard(photo_indices[id(photo)])) # each photo is no longer in progress once it is done, regardless of the others
 
         if len(self.photos) == 0:
             return
@@ -550,12 +548,15 @@ class GUI:
         self.update_IMG()
 
         # conservatively load extra images in background to speed up switching, while saving memory
+        to_load = []
         for i, photo in enumerate(self.photos):
             if (abs(i - photo_index) <= self.advanced_settings['preload']) and not hasattr(photo, 'RAW_IMG') and i not in self.in_progress: # preload photos in buffer ahead or behind of the currently selected one
-                threading.Thread(target=load_async, args=(photo, i), daemon=True).start()
+                to_load.append(i)
                 self.in_progress.add(i) # keeps track of photos in progress
             elif (abs(i - photo_index) > self.advanced_settings['preload']) and hasattr(photo, 'RAW_IMG'): # delete photos outside of buffer
                 photo.clear_memory()
+        if to_load:
+            threading.Thread(target=load_async, args=(to_load,), daemon=True).start()
 
         self.set_disable_buttons()
     
@@ -920,7 +921,7 @@ class GUI:
                 blank.load()
                 if blank.FileReadError:
                     messagebox.showerror('Read Blank', 'RAW image could not be read. Verify the integrity of the RAW image.')
-                raw_img = cv2.convertScaleAbs(blank.RAW_IMG, alpha=(255.0/65535.0))[:,:,::-1]
+                raw_img = blank.get_RAW_IMG_u8()[:,:,::-1]
                 brightness = np.sum(raw_img.astype(np.uint16), 2)
                 sample = np.percentile(brightness, 90) # take sample at 90th percentile brightest pixel
                 index = np.where(brightness==sample)
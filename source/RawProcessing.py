@@ -2,8 +2,11 @@ import rawpy
 import cv2
 import numpy as np
 from PIL import Image
-import matplotlib.colors
 import os 
+import math
+import mmap
+import json
+import threading
 
 import logging
 
@@ -42,6 +45,8 @@ class RawProcessing:
     )
     class_parameters = default_parameters.copy()
     advanced_attrs = [key for key in default_parameters.keys() if key not in ('filetype', 'frame', 'fit_aspect_ratio')] # list of keys for advanced settings, except for keys that should not be saved
+    max_buffer_size = 512 * 2 ** 20 # RAW files up to this size in bytes are read into memory in one go before decoding
+    load_slots = threading.BoundedSemaphore(os.cpu_count() or 1) # limits how many photos are decoded at once by load_many
     processing_parameters = ('dark_threshold','light_threshold','border_crop','flip','rotation','film_type','white_point','black_point','gamma','shadows','highlights','temp','tint','sat','reject','base_detect','base_rgb','remove_dust')
     
     def __init__(self, file_directory, default_settings, global_settings, config_path):
@@ -56,12 +61,19 @@ class RawProcessing:
         self.filename = os.path.basename(self.file_directory)
         self.colour_desc = None # RAW bayer colour description
         self.config_path = config_path
+        self.crop_cache = dict() # crops of the loaded images, keyed by the id of the source image
+        self.lut_cache = dict() # lookup tables of the tone adjustments, keyed by the adjustment name
         # initializing raw processing parameters
         try: # to read in the parameters from a saved file
-            directory = os.path.join(self.config_path, f"{self.filename.split('.')[0]}.npy")
-            params_dict = np.load(directory, allow_pickle=True).item()
+            directory = os.path.join(self.config_path, self.filename.split('.')[0])
+            if os.path.exists(f'{directory}.json'):
+                with open(f'{directory}.json') as f:
+                    params_dict = json.load(f)
+            else:
+                params_dict = np.load(f'{directory}.npy', allow_pickle=True).item() # settings saved by older versions
         except Exception as e:# file does not exist
-            logger.exception(f'Exception: {e}')
+            if not isinstance(e, FileNotFoundError): # most photos have no saved settings, logging a traceback for each one slows down large imports
+                logger.exception(f'Exception: {e}')
             for attr in self.processing_parameters:
                 if attr in global_settings:
                     setattr(self, attr, global_settings[attr]) # Initializes every instance parameter based on default value
@@ -71,7 +83,10 @@ class RawProcessing:
         else: # import successful
             for attr in self.processing_parameters:
                 if attr in params_dict:
-                    setattr(self, attr, params_dict[attr]) # Initializes every instance parameter with imported parameters
+                    value = params_dict[attr]
+                    if isinstance(value, list):
+                        value = tuple(value) # JSON stores tuples as lists
+                    setattr(self, attr, value) # Initializes every instance parameter with imported parameters
                 elif attr in default_settings:
                     setattr(self, attr, default_settings[attr]) # if parameter doesn't exist, use default
                 else:
@@ -82,7 +97,12 @@ class RawProcessing:
     def load(self, full_res=False):
         # Loads the RAW file into memory
         try:
-            with rawpy.imread(self.file_directory) as raw: # tries to read as raw file
+            if os.path.getsize(self.file_directory) <= self.max_buffer_size:
+                with open(self.file_directory, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                    raw = rawpy.imread(mapped_file) # rawpy copies the memory mapped file in a single read, much faster than libraw's many small reads, especially on network drives
+            else:
+                raw = rawpy.imread(self.file_directory)
+            with raw: # tries to read as raw file
                 self.RAW_IMG = raw.postprocess(
                     output_bps = 16, # output 16-bit image
                     use_camera_wb = self.class_parameters['use_camera_wb'], # Screws up the colours if not used
@@ -120,30 +140,90 @@ class RawProcessing:
             del gray, thresh
             cnt = max(contours, key=cv2.contourArea)
             x,y,w,h = cv2.boundingRect(cnt)
-            self.RAW_IMG = self.RAW_IMG[y:y+h,x:x+w,::-1]
+            self.RAW_IMG = cv2.cvtColor(self.RAW_IMG[y:y+h,x:x+w], cv2.COLOR_RGB2BGR) # contiguous BGR copy, instead of a reversed channel view
         
+        self.crop_cache = dict() # previous crops are no longer valid
+        img_u8 = cv2.convertScaleAbs(self.RAW_IMG, alpha=(255.0/65535.0))
+        self.RAW_IMG_gray = cv2.cvtColor(img_u8, cv2.COLOR_BGR2GRAY) # b&w copy used for thresholding
+        if full_res: # exports do not show the 8-bit copy, it is generated again by get_RAW_IMG_u8 if needed
+            if hasattr(self, 'RAW_IMG_u8'):
+                del self.RAW_IMG_u8
+        else:
+            self.RAW_IMG_u8 = img_u8 # 8-bit copy used for previews and colour picking
+        del img_u8
+
+        img_size = self.RAW_IMG.shape[0] + self.RAW_IMG.shape[1]
+        if (img_size > self.class_parameters['max_proxy_size']): # Checks if image is larger than the allowable size, if yes, then generate proxy images to speed up preview generation
+            # Downscales the image to a smaller size
+            scale_factor = self.class_parameters['max_proxy_size'] / img_size
+            x = int(self.RAW_IMG.shape[1] * scale_factor)
+            y = int(self.RAW_IMG.shape[0] * scale_factor)
+            self.proxy_RAW_IMG = cv2.resize(self.RAW_IMG, (x, y))
+            self.proxy_RAW_IMG_gray = cv2.resize(self.RAW_IMG_gray, (x, y), interpolation=cv2.INTER_AREA)
+            self.proxy = True # Flag to tell the rest of the program that proxies are being used
+        else:
+            self.proxy = False
         self.FileReadError = False
         self.memory_alloc = self.RAW_IMG.nbytes * 4 * 12 # estimation of memory requirements based on the size of the image
 
+    def get_RAW_IMG_u8(self):
+        # Returns the 8-bit copy of the RAW image used for previews and colour picking, generated when it is first needed
+        if not hasattr(self, 'RAW_IMG_u8'):
+            self.RAW_IMG_u8 = cv2.convertScaleAbs(self.RAW_IMG, alpha=(255.0/65535.0))
+        return self.RAW_IMG_u8
+
+    @staticmethod
+    def load_many(photos, full_res=False, callback=None):
+        # Loads multiple photos in parallel, RAW decoding releases the GIL so threads scale with the number of cores
+        # photos: list of RawProcessing objects
+        # callback: called with each photo as soon as it has finished loading, even if loading failed
+        # Each photo gets its own daemon thread, so closing the program does not wait for queued loads, and load_slots bounds how many decode at once
+        errors = []
+        def load(photo):
+            try:
+                with RawProcessing.load_slots:
+                    photo.load(full_res)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if callback is not None:
+                    callback(photo)
+        threads = [threading.Thread(target=load, args=(photo,), daemon=True) for photo in photos]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0] # re-raises errors only after every photo has been attempted
+
     def get_IMG(self, output=None, as_array=False):
         # Returns the converted image at different stages of the process, based on desired output
         if self.FileReadError: # Return nothing when file could not be read
             return
+        view_key = (output, self.rotation, self.flip, self.rect, self.border_crop, tuple(self.class_parameters['ignore_border']), self.class_parameters['ignore_neg_border'])
+        if output in ('RAW', 'Threshold', 'Contours'): # these views do not change with the colour adjustments, so the last one is reused while its inputs are the same
+            view_sources = (getattr(self, 'RAW_IMG', None), getattr(self, 'thresh', None))
+            if hasattr(self, 'view_IMG') and self.view_key == view_key and all(a is b for a, b in zip(self.view_sources, view_sources)):
+                output = 'Cached'
         match output:
+            case 'Cached': # return the previously generated view
+                img = self.view_IMG
             case 'RAW': # return RAW image
                 img = self.rotate(self.RAW_IMG) # apply rotation to image
             case 'Threshold': # return threshold image
                 img = self.thresh
                 img = self.rotate(img) # apply rotation to image
             case 'Contours': # generate contour image, then return it
-                thresh_img = np.uint8(cv2.cvtColor(self.thresh, cv2.COLOR_GRAY2BGR) / 2)
-                thresh_img[:,:,2] = 0 # sets colour of threshold image
+                thresh = cv2.resize(self.thresh, self.RAW_IMG_gray.shape[::-1], interpolation=cv2.INTER_NEAREST) # threshold is generated at a reduced size
+                half = cv2.LUT(thresh, (np.arange(256) / 2).astype(np.uint8)) # halves the 8-bit values through a lookup table, instead of dividing in floating point
+                thresh_img = cv2.merge([half, half, np.zeros_like(half)]) # sets colour of threshold image
 
-                indices = np.indices(thresh_img.shape[:2])
-                zebra_width = int(np.max(indices) / 100)
-                zebra = np.repeat((np.mod(indices[0] + indices[1], zebra_width * 2) > zebra_width)[:, :, np.newaxis], 3, axis=2)
-                thresh_img = np.where(zebra, 0, thresh_img) # applies zebra pattern to threshold image
-                img = cv2.addWeighted(cv2.convertScaleAbs(self.RAW_IMG, alpha=(255.0/65535.0)), 1, thresh_img, 0.2, 0) # add threshold image to RAW
+                rows = np.arange(thresh_img.shape[0], dtype=np.int32)[:, np.newaxis]
+                cols = np.arange(thresh_img.shape[1], dtype=np.int32)[np.newaxis, :]
+                zebra_width = max(int((max(thresh_img.shape[:2]) - 1) / 100), 1)
+                zebra = (rows + cols) % (zebra_width * 2) > zebra_width # diagonal stripes, broadcast from the row and column indices
+                thresh_img[zebra] = 0 # applies zebra pattern to threshold image
+                img = cv2.addWeighted(self.get_RAW_IMG_u8(), 1, thresh_img, 0.2, 0) # add threshold image to RAW
 
                 # drawing crop boxes
                 if self.rect is not None:
@@ -176,15 +256,16 @@ class RawProcessing:
                 img = self.rotate(img) # apply rotation to image
             case 'Histogram': # returns histogram of preview image
                 img = self.draw_histogram(self.IMG)
-                img = np.flip(img, 0)
-                mask = np.sum(img, 2) == 0
-                img[mask] = np.array(self.class_parameters['hist_bg_colour'])
             case _: # default case, return preview image
                 img = self.IMG
                 if self.remove_dust:
                     img = self.fill_dust(img, self.dust_mask)
                 img = self.add_frame(img) # add decorative white frame
                 img = self.rotate(img) # apply rotation to image
+        if output in ('RAW', 'Threshold', 'Contours'): # keep the newly generated view
+            self.view_IMG = img
+            self.view_key = view_key
+            self.view_sources = view_sources
         if as_array:
             return img
         else:
@@ -216,11 +297,12 @@ class RawProcessing:
 
     def save_settings(self):
         # saves the processing parameters to a file
-        directory = os.path.join(self.config_path, f"{self.filename.split('.')[0]}.npy") # uses the same name as the input file
+        directory = os.path.join(self.config_path, f"{self.filename.split('.')[0]}.json") # uses the same name as the input file
         params_dict = dict()
         for attr in self.processing_parameters:
             params_dict[attr] = getattr(self, attr)
-        np.save(directory, params_dict)
+        with open(directory, 'w') as f:
+            json.dump(params_dict, f, default=lambda x: x.tolist()) # numpy values are converted to python types
     
     def process(self, full_res=False, recent_only=False, skip_crop=False):
         # Selection of appropriate film processing type
@@ -235,23 +317,17 @@ class RawProcessing:
 
         if not skip_crop or not hasattr(self, 'thresh'):
             self.thresh, self.rect, self.largest_contour = self.find_optimal_crop()
-            
-            img_size = self.RAW_IMG.shape[0] + self.RAW_IMG.shape[1]
-            if (img_size > self.class_parameters['max_proxy_size']): # Checks if image is larger than the allowable size, if yes, then generate proxy images to speed up preview generation
-                # Downscales the image to a smaller size
-                scale_factor = self.class_parameters['max_proxy_size'] / img_size
-                x = int(self.RAW_IMG.shape[1] * scale_factor)
-                y = int(self.RAW_IMG.shape[0] * scale_factor)
-                self.proxy_RAW_IMG = cv2.resize(self.RAW_IMG, (x, y))
-                self.proxy = True # Flag to tell the rest of the program that proxies are being used
+            self.crop_cache = dict() # cached crops were made with the previous crop box
 
         # Uses a proxy to generate preview, when needed. During final export, will use full resolution
         if self.proxy and not full_res:
             img = self.proxy_RAW_IMG
+            imgray = self.proxy_RAW_IMG_gray
         else:
             img = self.RAW_IMG
+            imgray = self.RAW_IMG_gray
 
-        dust_mask = self.find_dust(self.crop(img, self.rect))
+        dust_mask = self.find_dust(self.crop(imgray, self.rect, cache=True)) # the b&w image does not change between slider adjustments, so its crop is reused
 
         # Additional processing specific to each film type
         match self.film_type:
@@ -277,52 +353,52 @@ class RawProcessing:
 
     def bw_negative_processing(self, img):
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) # converts to b/w
-        img = 65535 - img # invert to create positive image
-        img = self.hist_EQ(img) # increases contrast to maximize dynamic range
-        img = self.exposure(img) # exposure adjustment
-        img = img.clip(0, 65535).astype(np.uint16, copy=True)
+        img = self.hist_EQ(img, invert=True, tone=self.exposure) # invert to create positive image, and increases contrast to maximize dynamic range, with exposure adjustment in the same lookup
         return img
 
     def colour_negative_processing(self, img):
-        img = 65535 - img # invert to create positive image
-        img = self.slide_processing(img) # The rest of the processing is identical to slide_processing
+        img = self.slide_processing(img, invert=True) # The rest of the processing is identical to slide_processing, once inverted to create positive image
         return img
     
-    def slide_processing(self, img):
-        img = self.hist_EQ(img) # Maximizes dynamic range
-        wb_mode = [self.wb_adjust, self.wb_adjust_coeff, self.wb_adjust_gamma] # different ways to adjust wb, for debugging
-        img = wb_mode[1](img) # modifiers for white balancing
-        img = self.exposure(img) # Exposure adjustment
+    def slide_processing(self, img, invert=False):
+        # invert: inverts the image before processing, for negatives
+        # white balance is applied as coefficients, wb_adjust and wb_adjust_gamma are alternatives kept for debugging
+        pick = self.pick_wb # read once, the picker can be enabled from the GUI thread while the photo is processing
+        if pick: # the white balance picker samples the equalized image, so the steps are applied to the image one at a time
+            self.pick_wb = False
+            img = self.hist_EQ(img, invert) # Maximizes dynamic range
+            self.wb_picker_coeff(img) # calculates temp and tint from the picked pixels
+            img = self.wb_apply_coeff(img) # modifiers for white balancing
+            img = self.exposure(img) # Exposure adjustment
+        else: # white balance and exposure only depend on each channel's value, so they are folded into the equalization lookup tables
+            img = self.hist_EQ(img, invert, tone=lambda luts: self.exposure(self.wb_apply_coeff(luts)))
         img = self.sat_adjust(img) # modifier for colour saturation
-        img = img.clip(0, 65535).astype(np.uint16, copy=True)
         return img
         
     def crop_only(self, img):
         # No processing required
         return img
     
-    def find_dust(self, img):
+    def find_dust(self, imgray):
         # work in progress. Tries to detect dust particles of a maximum size, then returns threshold image of just dust
-        y, x, _ = img.shape
+        # imgray: 8-bit b&w image
+        y, x = imgray.shape
         img_size = (x + y) / 2
         multiplier = img_size / 800
         max_dust_size = multiplier ** 2 * self.class_parameters['max_dust_area']
         kernel_size = max(round(multiplier) * 2 + 1,1)
         kernel = np.ones((kernel_size,kernel_size),np.uint8)
-        x, y = (np.array(self.class_parameters['ignore_border']) / 100 * img.shape[:2][::-1]).astype(np.int32) # calculates the width of the border to ignore in pixels
+        x, y = (np.array(self.class_parameters['ignore_border']) / 100 * imgray.shape[::-1]).astype(np.int32) # calculates the width of the border to ignore in pixels
         if x * y == 0:
             sample = np.s_[:]
         else:
             sample = np.s_[y:-y, x:-x]
 
-        img8 = cv2.convertScaleAbs(img, alpha=(255.0/65535.0))
-        imgray = cv2.cvtColor(img8, cv2.COLOR_BGR2GRAY) # converts to b&w
-        minimum = np.percentile(imgray[sample], 0.5)
-        maximum = np.percentile(imgray[sample], 99.5)
+        minimum, maximum = self.hist_percentile([imgray[sample]], (0.5, 99.5))[:, 0]
         threshold = (maximum - minimum) * self.class_parameters['dust_threshold'] / 100 + minimum
         _, thresh = cv2.threshold(imgray, threshold, 255, cv2.THRESH_BINARY_INV)
-        thresh_img = cv2.dilate(thresh,kernel,iterations = self.class_parameters['dust_iter'])
-        thresh_img = cv2.erode(thresh_img,kernel,iterations = self.class_parameters['dust_iter'])
+        close_size = (kernel_size - 1) * self.class_parameters['dust_iter'] + 1 # repeated passes of a square kernel are equivalent to a single pass of a larger one
+        thresh_img = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, np.ones((close_size,close_size),np.uint8)) # dilate then erode in one call
         contours, _ = cv2.findContours(thresh_img, 1, 2)
         contours = sorted(contours, key=lambda x: cv2.contourArea(x))
         smallest = [contour for contour in contours if cv2.contourArea(contour) < max_dust_size]
@@ -333,50 +409,44 @@ class RawProcessing:
     
     def fill_dust(self, img, dust_mask):
         # work in progress, uses dust threshold image to erase dust
-        if len(img.shape) == 3:
-            channels = cv2.split(img)
-            filled = []
-            for channel in channels:
-                filled.append(cv2.inpaint(channel, dust_mask, 3, cv2.INPAINT_TELEA))
-            filled = cv2.merge(filled)
+        if len(img.shape) == 3 and img.dtype == np.uint16:
+            # inpainting only supports 3 channels at 8-bit, so fill all channels in one pass, then copy only the dust pixels back at 16-bit
+            filled_8bit = cv2.inpaint(cv2.convertScaleAbs(img, alpha=(255.0/65535.0)), dust_mask, 3, cv2.INPAINT_TELEA)
+            dust = dust_mask > 0
+            filled = img.copy()
+            filled[dust] = filled_8bit[dust].astype(np.uint16) * 257
         else:
             filled = cv2.inpaint(img, dust_mask, 3, cv2.INPAINT_TELEA)
         return filled
 
     def find_optimal_crop(self):
         # Determines the optimal crop around an image and corrects for misalignment/rotation
-        thresh = self.get_threshold(self.RAW_IMG)
+        # The film border is detected on the proxy, which is plenty to locate it
+        imgray = self.proxy_RAW_IMG_gray if self.proxy else self.RAW_IMG_gray
+        thresh = self.get_threshold(imgray, imgray.shape[1] / self.RAW_IMG_gray.shape[1])
         #thresh = self.get_edges(img) # experimental threholding using edge detection
         contours, _ = cv2.findContours(thresh, 1, 2)
         if len(contours) == 0:
             return thresh, None, None # if no contours are found, skip cropping
         largest_contour = max(contours, key=cv2.contourArea)
         rect = cv2.minAreaRect(largest_contour) # bounding box of largest contour
-        y, x = self.RAW_IMG.shape[0], self.RAW_IMG.shape[1]
+        y, x = thresh.shape
         if rect[2] <= 0:
             rect = ((rect[0][0], rect[0][1]), (rect[1][1], rect[1][0]), rect[2] + 90) # correction for if the rectangle rotation is exactly zero
         rect = ((rect[0][0]/y, rect[0][1]/x), (rect[1][0]/y, rect[1][1]/x), rect[2]) # normalizes crop for different sized images
+        largest_contour = (largest_contour * (np.array(self.RAW_IMG_gray.shape[::-1]) / (x, y))).astype(np.int32) # scales contour back to the size of the RAW image
         return thresh, rect, largest_contour
     
-    def crop(self, img, rect, include_EQ_ignore=False):
+    def crop(self, img, rect, include_EQ_ignore=False, cache=False):
+        # cache: reuses the last crop of the same image if the crop parameters have not changed, only for images that are never modified
         if rect is not None:
-            if img.shape[0] > img.shape[1]:
-                x_crop = self.border_crop
-                y_crop = self.border_crop * img.shape[1] / img.shape[0]
-            else:
-                y_crop = self.border_crop
-                x_crop = self.border_crop * img.shape[0] / img.shape[1]
-            y, x = img.shape[0], img.shape[1]
-            rect = ((rect[0][0]*y, rect[0][1]*x), (rect[1][0]*y, rect[1][1]*x), rect[2]) # convert normalized crop to corresponding pixel coordinates
-            box = cv2.boxPoints(rect)
-            box = np.int64(box)
-            if not (include_EQ_ignore and self.class_parameters['ignore_neg_border']):
-                box = self.shrink_box(box, x_crop, y_crop)
-            if include_EQ_ignore:
-                ignore_border = np.array(self.class_parameters['ignore_border'])
-                box = self.shrink_box(box, ignore_border[0], ignore_border[1])
-            width = int(rect[1][1] * (1 - x_crop / 100))
-            height = int(rect[1][0] * (1 - y_crop / 100))
+            if cache:
+                source = img
+                key = (rect, self.border_crop, include_EQ_ignore, tuple(self.class_parameters['ignore_border']), self.class_parameters['ignore_neg_border'])
+                cached = self.crop_cache.get(id(source))
+                if cached is not None and cached[0] is source and cached[1] == key: # identity check guards against reused ids
+                    return cached[2]
+            box, width, height = self.get_crop_box(img.shape, rect, include_EQ_ignore)
             src_pts = box.astype('float32')
             dst_pts = np.array([[0, width-1],
                             [0, 0],
@@ -386,7 +456,30 @@ class RawProcessing:
             img = cv2.warpPerspective(img, M, (height, width))
             if rect[2] > 45:
                 img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE) # rotates image back if it has been rotated
+            if cache:
+                self.crop_cache[id(source)] = (source, key, img)
         return img
+
+    def get_crop_box(self, shape, rect, include_EQ_ignore=False):
+        # Converts the normalized crop to the pixel coordinates of the box corners, and the dimensions of the cropped image
+        if shape[0] > shape[1]:
+            x_crop = self.border_crop
+            y_crop = self.border_crop * shape[1] / shape[0]
+        else:
+            y_crop = self.border_crop
+            x_crop = self.border_crop * shape[0] / shape[1]
+        y, x = shape[0], shape[1]
+        rect = ((rect[0][0]*y, rect[0][1]*x), (rect[1][0]*y, rect[1][1]*x), rect[2]) # convert normalized crop to corresponding pixel coordinates
+        box = cv2.boxPoints(rect)
+        box = np.int64(box)
+        if not (include_EQ_ignore and self.class_parameters['ignore_neg_border']):
+            box = self.shrink_box(box, x_crop, y_crop)
+        if include_EQ_ignore:
+            ignore_border = np.array(self.class_parameters['ignore_border'])
+            box = self.shrink_box(box, ignore_border[0], ignore_border[1])
+        width = int(rect[1][1] * (1 - x_crop / 100))
+        height = int(rect[1][0] * (1 - y_crop / 100))
+        return box, width, height
     
     def get_edges(self, img):
         # experimental, attempt at smarter image thresholding, not used
@@ -410,24 +503,41 @@ class RawProcessing:
             output = 255 - output
         return output
 
-    def get_threshold(self, img):
+    def get_threshold(self, imgray, scale=1):
         # Generates the threshold image used to find contours
-        img = cv2.convertScaleAbs(img, alpha=(255.0/65535.0))
-        imgray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) # converts to b&w
+        # imgray: 8-bit b&w image
+        # scale: size of imgray relative to the RAW image, to keep the erosion proportional to the image
         dark_threshold = int(self.dark_threshold / 100 * 255)
-        _, dark_thresh_img = cv2.threshold(imgray, dark_threshold, 255, 0)
         light_threshold = int(self.light_threshold / 100 * 255)
-        _, light_thresh_img = cv2.threshold(imgray, light_threshold, 255, cv2.THRESH_BINARY_INV)
-        thresh_img = cv2.bitwise_and(dark_thresh_img, light_thresh_img)
-        kernel = np.ones((7,7),np.uint8)
+        thresh_img = cv2.inRange(imgray, dark_threshold + 1, light_threshold) # keeps pixels brighter than the dark threshold, up to the light threshold
+        kernel_size = max(int(7 * scale) // 2 * 2 + 1, 3)
+        kernel = np.ones((kernel_size,kernel_size),np.uint8)
         thresh_img = cv2.erode(thresh_img, kernel, iterations = 2)
         return thresh_img
     
-    def hist_EQ(self, img):
+    def hist_EQ(self, img, invert=False, tone=None):
         # Equalizes histogram for each color channel
+        # invert: inverts the image as part of the same lookup table, instead of a separate pass over the image
+        # tone: optional adjustment that only depends on each channel's value, applied to the lookup tables so the planes are only looked up once
+        # Values are not clipped to the 16-bit range here, highlights above the white point are only clipped by the exposure adjustment, after white balance
         sensitivity = 0.2 # multiplier to adjust degree at which the sliders affect the output image
 
-        sample_img = self.crop(img, self.rect, include_EQ_ignore=True)
+        channels = cv2.split(img) # separate contiguous plane for each colour channel
+        if self.rect is None:
+            sample_mask = None
+        else: # only sample pixels inside the crop, without the ignored border
+            box, _, _ = self.get_crop_box(img.shape, self.rect, include_EQ_ignore=True)
+            sample_mask = cv2.fillPoly(np.zeros(img.shape[:2], np.uint8), [box], 255)
+
+        samples = channels
+        img_size = img.shape[0] + img.shape[1]
+        if img_size > self.class_parameters['max_proxy_size']: # samples full resolution images at the proxy size, so that the export matches the preview
+            scale_factor = self.class_parameters['max_proxy_size'] / img_size
+            size = (int(img.shape[1] * scale_factor), int(img.shape[0] * scale_factor))
+            samples = [cv2.resize(channel, size) for channel in channels] # same interpolation as the proxy image, so the samples have the same noise and percentile tails
+            if sample_mask is not None:
+                sample_mask = cv2.resize(sample_mask, size, interpolation=cv2.INTER_NEAREST)
+        black_percentile, white_percentile = self.hist_percentile(samples, (self.class_parameters['black_point_percentile'], self.class_parameters['white_point_percentile']), sample_mask, invert)
 
         if self.base_detect and (self.film_type == 1 or self.film_type == 2):
             if self.film_type == 1:
@@ -435,18 +545,22 @@ class RawProcessing:
             else:
                 black_point = np.array(self.base_rgb, np.uint16)[::-1] * 256
         else:
-            black_point = np.percentile(sample_img, self.class_parameters['black_point_percentile'], (0,1))
+            black_point = black_percentile
         black_offsets = self.black_point / 100 * sensitivity * 65535 - black_point
-        img = img.astype(np.float64, copy=False)
-        sample_img = sample_img.astype(np.float32, copy=False)
-        
-        img[:,:] += black_offsets # Sets the black point
-        sample_img[:,:] += black_offsets
 
         max_array = np.ones_like(black_offsets)
-        white_point = np.percentile(sample_img, self.class_parameters['white_point_percentile'], (0,1))
+        white_point = white_percentile + black_offsets # percentile of the black point adjusted sample
         white_multipliers = np.divide(65535 + self.white_point / 100 * sensitivity * 65535, white_point, out=max_array, where=white_point>0) # division, but ignore divide by zero or negative
-        img = np.multiply(img, white_multipliers) # Scales the white percentile to 65535
+
+        # Black point offset and white point scaling are a per channel affine map of 16-bit values, so it is applied as a lookup table
+        values = np.arange(65536, dtype=np.float32)
+        luts = [(values + np.float32(offset)) * np.float32(multiplier) for offset, multiplier in zip(np.atleast_1d(black_offsets), np.atleast_1d(white_multipliers))]
+        if invert:
+            luts = [lut[::-1] for lut in luts] # looks up the inverted value, 65535 - value
+        if tone is not None:
+            tone_luts = tone(np.stack(luts, -1)[:, np.newaxis]) # the lookup tables as a 65536 x 1 image with the same channels
+            luts = [tone_luts[:, 0, i] for i in range(len(luts))]
+        img = cv2.merge([lut[channel] for lut, channel in zip(luts, channels)])
         return img
     
     # \/ Three different white balance functions experimented with \/
@@ -456,21 +570,14 @@ class RawProcessing:
         multiplier = 200
         if self.pick_wb: # logic to calculated temp and tint values from the wb picker
             self.pick_wb = False
-            x, y, r = self.wb_picker_params # unpacks parameters passed in from white balance picker
-            wb_mask = self.rotate(np.zeros_like(self.crop(img, self.rect)[:,:,0], dtype=np.uint8)) # generate blank mask, rotate to same orientation as preview image
-            # applying scale factors based on image size
-            x = int(x * wb_mask.shape[1])
-            y = int(y * wb_mask.shape[0])
-            radius = int(min(wb_mask.shape) * r)
-
-            wb_mask = cv2.circle(wb_mask, (x, y), radius, 255, -1) # generate small circle to average pixels with
-            wb_mask = self.rotate(wb_mask, True) # rotate image back to default orientation
-            meanBGR = cv2.mean(self.crop(img, self.rect), wb_mask) # returns BGR tuple containing average of unmasked pixels
+            meanBGR = self.picker_mean(self.crop(img, self.rect), *self.wb_picker_params) # returns BGR tuple containing average of the picked pixels
             # calculating temp and tint values required to balance average BGR to gray
             G_offset =  (meanBGR[0] + meanBGR[2]) / 2 - meanBGR[1]
             RB_offset = meanBGR[0] - (meanBGR[0] + meanBGR[2]) / 2
             self.temp = max(min(RB_offset / multiplier, 100), -100)
             self.tint = max(min(G_offset / multiplier, 100), -100)
+        if self.temp == 0 and self.tint == 0:
+            return img # neutral white balance, nothing to add
         adjustment = np.array([-self.temp * multiplier, -self.tint * multiplier, self.temp * multiplier], np.float32)
         img = np.add(img, adjustment)
         return img
@@ -478,91 +585,129 @@ class RawProcessing:
     def wb_adjust_coeff(self, img):
         # Applies white balance adjustment factors as coefficients multiplied into RGB
         # only highlights white balance affected
-        multiplier = 200
         if self.pick_wb: # logic to calculated temp and tint values from the wb picker
             self.pick_wb = False
-            x, y, r = self.wb_picker_params # unpacks parameters passed in from white balance picker
-            wb_mask = self.rotate(np.zeros_like(self.crop(img, self.rect)[:,:,0], dtype=np.uint8)) # generate blank mask, rotate to same orientation as preview image
-            # applying scale factors based on image size
-            x = int(x * wb_mask.shape[1])
-            y = int(y * wb_mask.shape[0])
-            radius = int(min(wb_mask.shape) * r)
-
-            wb_mask = cv2.circle(wb_mask, (x, y), radius, 255, -1) # generate small circle to average pixels with
-            wb_mask = self.rotate(wb_mask, True) # rotate image back to default orientation
-            B, G, R, _ = cv2.mean(self.crop(img, self.rect), wb_mask) # returns BGR tuple containing average of unmasked pixels
-            # calculating temp and tint values required to balance average BGR to gray
-            self.tint = max(min((G/B+G/R-2)/((B*(G+R)+R*G)/(B*R)) * multiplier, 100), -100)
-            self.temp = max(min(((2*G-(2*G+R)*self.tint/multiplier)/2/R-1) * multiplier, 100), -100)
-        
-        img = np.multiply(img, np.array([1-self.temp/multiplier+self.tint/multiplier/2, 1-self.tint/multiplier, 1+self.temp/multiplier+self.tint/multiplier/2]))
+            self.wb_picker_coeff(img)
+        return self.wb_apply_coeff(img)
+
+    def wb_picker_coeff(self, img):
+        # Calculates the temp and tint values for wb_apply_coeff that balance the pixels picked by the wb picker to gray
+        multiplier = 200
+        B, G, R, _ = self.picker_mean(self.crop(img, self.rect), *self.wb_picker_params) # returns BGR tuple containing average of the picked pixels
+        self.tint = max(min((G/B+G/R-2)/((B*(G+R)+R*G)/(B*R)) * multiplier, 100), -100)
+        self.temp = max(min(((2*G-(2*G+R)*self.tint/multiplier)/2/R-1) * multiplier, 100), -100)
+
+    def wb_apply_coeff(self, img):
+        # Multiplies the white balance coefficients into each channel, without reading the picker, so it can also be applied to lookup tables
+        multiplier = 200
+        if self.temp == 0 and self.tint == 0:
+            return img # neutral white balance, all coefficients are 1
+        coefficients = (1-self.temp/multiplier+self.tint/multiplier/2, 1-self.tint/multiplier, 1+self.temp/multiplier+self.tint/multiplier/2, 0) # BGR, padded to a 4-element scalar
+        img = cv2.multiply(img, coefficients) # keeps the unclipped float values, exposure clips them to 16-bit afterwards
         return img
     
     def wb_adjust_gamma(self, img):
         # Applies white balance adjustment factors using gamma function, not used
         # Highlights and shadows stay the same, only midtones' white balance affected
-        img = img / 65535
         if self.pick_wb: # logic to calculated temp and tint values from the wb picker
             self.pick_wb = False
-            x, y, r = self.wb_picker_params # unpacks parameters passed in from white balance picker
-            wb_mask = self.rotate(np.zeros_like(self.crop(img, self.rect)[:,:,0], dtype=np.uint8)) # generate blank mask, rotate to same orientation as preview image
-            # applying scale factors based on image size
-            x = int(x * wb_mask.shape[1])
-            y = int(y * wb_mask.shape[0])
-            radius = int(min(wb_mask.shape) * r)
-
-            wb_mask = cv2.circle(wb_mask, (x, y), radius, 255, -1) # generate small circle to average pixels with
-            wb_mask = self.rotate(wb_mask, True) # rotate image back to default orientation
-            meanBGR = cv2.mean(self.crop(img, self.rect), wb_mask) # returns BGR tuple containing average of unmasked pixels
-            # calculating temp and tint values required to balance average BGR to gray
-            target = (meanBGR[0] + meanBGR[2]) / 2
-            self.temp = 100 * np.log2(np.log(target) / np.log(meanBGR[0]))
-            self.tint = -100 * np.log2(np.log(target) / np.log(meanBGR[1]))
+            meanBGR = [value / 65535 for value in self.picker_mean(self.crop(img, self.rect), *self.wb_picker_params)] # returns normalized BGR tuple containing average of the picked pixels
+            if all(0 < value < 1 for value in meanBGR[:3]): # black or clipped white pixels have no gamma that balances them, so the white balance is left unchanged
+                # calculating temp and tint values required to balance average BGR to gray
+                target = (meanBGR[0] + meanBGR[2]) / 2
+                self.temp = 100 * math.log2(math.log(target) / math.log(meanBGR[0]))
+                self.tint = -100 * math.log2(math.log(target) / math.log(meanBGR[1]))
         
-        img = np.power(img, (2 ** np.array([self.temp/100, self.tint/100, -self.temp/100])), dtype=np.float32)
-
-        img = img * 65535 # restores orginal range prior to normalization
+        if self.temp == 0 and self.tint == 0:
+            return img # neutral white balance, all exponents are 1
+        if img.dtype != np.uint16:
+            img = np.clip(img, 0, 65535) # the lookup tables only cover the 16-bit range
+            img = np.rint(img, out=img).astype(np.uint16)
+        # the gamma of each channel is applied with a lookup table of every 16-bit value
+        params = (self.temp, self.tint)
+        cached = self.lut_cache.get('wb_gamma')
+        if cached is not None and cached[0] == params:
+            luts = cached[1]
+        else:
+            values = np.arange(65536, dtype=np.float32) / 65535
+            luts = [np.rint(np.power(values, exponent, dtype=np.float32) * 65535).astype(np.uint16) for exponent in 2 ** np.array([self.temp/100, self.tint/100, -self.temp/100])]
+            self.lut_cache['wb_gamma'] = (params, luts)
+        img = cv2.merge([lut[channel] for lut, channel in zip(luts, cv2.split(img))])
         return img
     
     def exposure(self, img):
         # Exposure adjustment
-        norm = matplotlib.colors.Normalize(0, 65535, True)
-        img = norm(img).astype(np.float32, copy=False)
-        
-        img = (img ** (2 ** (-self.gamma/100))).astype(np.float32, copy=False) # gamma adjustment via gamma correction
+        # The adjustment only depends on the value of each pixel, so it is calculated once for every 16-bit value as a lookup table
+        if img.dtype != np.uint16:
+            img = np.clip(img, 0, 65535) # values outside of the 16-bit range are clipped by the normalization anyway
+            img = np.rint(img, out=img).astype(np.uint16) # rounded in the clipped copy instead of allocating another array
+        if self.gamma == 0 and self.shadows == 0 and self.highlights == 0:
+            return img # no exposure adjustment, the lookup table would map every value to itself
+        params = (self.gamma, self.shadows, self.highlights)
+        cached = self.lut_cache.get('exposure')
+        if cached is not None and cached[0] == params:
+            return cached[1][img] # same adjustment as last time, reuse the lookup table
         
-        # Highlights and shadows formula
+        lut = np.arange(65536, dtype=np.float32)
+        lut *= 1 / 65535 # normalize to (0,1)
+        np.power(lut, 2 ** (-self.gamma/100), out=lut) # gamma adjustment via gamma correction
+    
+        # Highlights and shadows formula, evaluated in place on scratch arrays to avoid temporaries
+        scratch = np.empty_like(lut)
         shadows_coefficient = 4.15e-5 * self.shadows ** 2 + 0.02185 * self.shadows
-        img += (shadows_coefficient * np.minimum(img - 0.75, 0) ** 2) * img
+        np.subtract(lut, 0.75, out=scratch)
+        np.minimum(scratch, 0, out=scratch)
+        np.square(scratch, out=scratch)
+        scratch *= shadows_coefficient
+        scratch *= lut
+        lut += scratch
 
         highlights_coefficient = -4.15e-5 * self.highlights ** 2 + 0.02185 * self.highlights
-        img += (highlights_coefficient * np.maximum(img - 0.25, 0) ** 2) * (1 - img)
-
-        img = np.ma.getdata(img, False) # converts masked array back to normal array
-        
-        img = img * 65535 # restores orginal range prior to normalization
-
-        return img
+        np.subtract(lut, 0.25, out=scratch)
+        np.maximum(scratch, 0, out=scratch)
+        np.square(scratch, out=scratch)
+        scratch *= highlights_coefficient
+        scratch *= 1 - lut
+        lut += scratch
+    
+        lut *= 65535 # restores orginal range prior to normalization
+        lut = np.rint(np.clip(lut, 0, 65535, out=lut), out=lut).astype(np.uint16)
+        self.lut_cache['exposure'] = (params, lut)
+        return lut[img]
     
     def sat_adjust(self, img):
         # Applies saturation adjustment factors
         if self.sat == 100:
             return img # don't run the calculation if no changes are to be made
         sat_adjust = self.sat / 100
-        norm = matplotlib.colors.Normalize(0, 65535, True)
-        img = norm(np.flip(img, 2)).astype(np.float32, copy=False) # Convert from bgr to rgb, and normalize input to (0,1)
-        img = matplotlib.colors.rgb_to_hsv(img) # Convert from rgb to hsv
-        img[:,:,1] = np.clip(img[:,:,1] * sat_adjust, 0, 1) # Apply saturation adjustment
-        img = matplotlib.colors.hsv_to_rgb(img) # Convert from hsv back to rgb
-        img = np.flip(img, 2) * 65535 # Convert from rgb to bgr
+        # Scaling HSV saturation keeps hue and value (the channel maximum) fixed, so every channel is pulled towards or pushed away from the maximum by the same factor
+        # This is evaluated directly on BGR values instead of converting to HSV and back
+        # The channels stay as 16-bit planes, only the per pixel factor and one channel at a time are held as float32
+        channels = list(cv2.split(img))
+        maximum = cv2.max(cv2.max(channels[0], channels[1]), channels[2])
+        chroma = cv2.subtract(maximum, cv2.min(cv2.min(channels[0], channels[1]), channels[2]))
+        coefficient = cv2.divide(maximum, chroma, dtype=cv2.CV_32F) # saturation is clipped at 1, where the smallest channel reaches 0. Gray pixels give 0 and are left unchanged
+        np.minimum(coefficient, sat_adjust, out=coefficient)
+        for i, channel in enumerate(channels):
+            distance = cv2.multiply(cv2.subtract(maximum, channel, dtype=cv2.CV_32F), coefficient)
+            channels[i] = cv2.subtract(maximum, distance, dtype=cv2.CV_16U) # rounds and saturates straight back to 16-bit
+        img = cv2.merge(channels)
         return img
     
     def rotate(self, img, undo=False):
         # Applies flip and rotation to image
         rotation = self.rotation % 4
+        if rotation == 0 and not self.flip:
+            return img # default orientation
+        if self.flip: # flips combined with these rotations are a single transform, which is its own inverse
+            match rotation:
+                case 1:
+                    return cv2.transpose(img)
+                case 2:
+                    return cv2.flip(img, 0)
         if undo: # option for reverse operation
             if self.flip:
-                img = np.ascontiguousarray(img[:,::-1])
+                img = cv2.flip(img, 1)
             match rotation:
                 case 0:
                     pass
@@ -583,40 +728,47 @@ class RawProcessing:
                 case 3: 
                     img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
             if self.flip:
-                img = np.ascontiguousarray(img[:,::-1])
+                img = cv2.flip(img, 1)
         return img
     
     def draw_histogram(self, img):
         # Generates histogram plot of image
-        hist_plot = np.zeros(self.class_parameters['histogram_plt_size'], np.uint8) # Base image for the histogram
         width = self.class_parameters['histogram_plt_size'][1]
         height = self.class_parameters['histogram_plt_size'][0] - 10 # Leave a little border from the top
-        histograms = []
-        maxes = []
         if len(img.shape) == 2: # Determines if the image is grayscale
             channels = [img]
-            colours = [(255, 255, 255)]
         else:
             channels = cv2.split(img)
-            colours = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
         bins = [256] # The number of divisions in the histogram
         smoothing = 5
-        for channel in channels:
-            hist = cv2.calcHist([channel], [0], None, bins, [0, 65536]) # Generates the histogram
-            maxes.append(np.max(hist)) # Keeps track of the maximum value of the histogram
-            hist[1:-1] = cv2.GaussianBlur(hist[1:-1], (smoothing,smoothing), 0) # Smooths out the histogram
-            hist = np.squeeze(hist)
-            histograms.append(hist)
-        
-        for (hist, colour) in zip(histograms, colours):
-            if np.max(maxes) != 0:
-                hist = hist / np.max(maxes) * height # Scales all histograms to fit in the image
-            pts = np.stack((np.linspace(0, width, len(hist)), hist), -1).reshape(-1,1,2).squeeze().tolist() # Reformats hist into a list of 2d points
-            pts.insert(0, [0, 0])
-            pts.append([width, 0])
-            new_plot = np.zeros(self.class_parameters['histogram_plt_size'], np.uint8)
-            new_plot = cv2.fillPoly(new_plot, np.array([pts]).astype(np.int32), color=colour) # Generates histogram as a polygon
-            hist_plot = hist_plot + new_plot # Add current histogram channel to the overall histogram plot
+        hist = np.stack([cv2.calcHist([channel], [0], None, bins, [0, 65536]).reshape(-1) for channel in channels], -1) # Generates the histograms, one column per channel
+        maximum = np.max(hist) # Keeps track of the maximum value of the histograms
+        hist[1:-1] = cv2.GaussianBlur(hist[1:-1], (1, smoothing), 0) # Smooths out each histogram along its bins
+        if maximum != 0:
+            hist = hist / maximum * height # Scales all histograms to fit in the image
+
+        # Reformats the histograms into polygons, starting and ending on the baseline
+        pts = np.empty((len(channels), bins[0] + 2, 2), np.int32)
+        pts[:, 0] = (0, 0)
+        pts[:, -1] = (width, 0)
+        pts[:, 1:-1, 0] = np.linspace(0, width, bins[0])
+        pts[:, 1:-1, 1] = hist.T
+
+        planes = []
+        for channel_pts in pts:
+            plane = np.zeros(self.class_parameters['histogram_plt_size'][:2], np.uint8)
+            planes.append(cv2.fillPoly(plane, [channel_pts], 255)) # Generates histogram as a polygon, in its own colour channel
+        if len(planes) == 1:
+            planes = planes * 3 # grayscale histogram is plotted in white
+
+        # Fills the background colour wherever none of the histograms were drawn
+        background = planes[0]
+        for plane in planes[1:]:
+            background = cv2.bitwise_or(background, plane)
+        background = cv2.bitwise_not(background)
+        planes = [cv2.bitwise_or(plane, cv2.bitwise_and(background, colour)) for plane, colour in zip(planes, self.class_parameters['hist_bg_colour'])]
+        hist_plot = cv2.merge(planes)
+        hist_plot = cv2.flip(hist_plot, 0) # the polygons are drawn from the top row, flipped once so the baseline is at the bottom for display
         return hist_plot
     
     def add_frame(self, img):
@@ -625,32 +777,33 @@ class RawProcessing:
                 return img # skip if aspect ratio and frame have default values
 
         frame_size = max(1, int(min(img.shape[:2]) * self.class_parameters['frame'] / 100)) # at least one pixel wide frame
-        new_shape = (img.shape[0] + 2 * frame_size, img.shape[1] + 2 * frame_size) + img.shape[2:]
-        frame_img = np.ones(new_shape, dtype=img.dtype) * 65535
-        frame_img[frame_size:-frame_size, frame_size:-frame_size] = img # center image inside frame
+        height, width = img.shape[0] + 2 * frame_size, img.shape[1] + 2 * frame_size
+        top, left = frame_size, frame_size # position of image inside the output
 
         if self.class_parameters['fit_aspect_ratio'] != 'Keep Original': # fit image to aspect ratio
             target_w, target_h = map(int, self.class_parameters['fit_aspect_ratio'].split(' ', 1)[0].split(':')) # parse 'W:H (text)' to W, H
             target_ratio = target_w / target_h
-            current_ratio = frame_img.shape[1] / frame_img.shape[0]
+            current_ratio = width / height
             if current_ratio > target_ratio: # image is wider than target aspect ratio
-                new_height = int(frame_img.shape[1] / target_ratio)
-                pad = (new_height - frame_img.shape[0]) // 2
-                padding = ((pad, pad + (new_height - frame_img.shape[0]) % 2), (0, 0)) + (() if img.ndim == 2 else ((0, 0),))
+                new_height = int(width / target_ratio)
+                top += (new_height - height) // 2
+                height = new_height
             else:
-                new_width = int(frame_img.shape[0] * target_ratio)
-                pad = (new_width - frame_img.shape[1]) // 2
-                padding = ((0, 0), (pad, pad + (new_width - frame_img.shape[1]) % 2)) + (() if img.ndim == 2 else ((0, 0),))
-            frame_img = np.pad(frame_img, padding, mode='constant', constant_values=65535)
+                new_width = int(height * target_ratio)
+                left += (new_width - width) // 2
+                width = new_width
 
+        frame_img = np.full((height, width) + img.shape[2:], 65535, dtype=img.dtype) # the frame and padding are filled in a single allocation
+        frame_img[top:top + img.shape[0], left:left + img.shape[1]] = img # center image inside frame
         return frame_img
 
     def clear_memory(self):
         # Deletes instances of images to save memory
-        to_del = ['IMG', 'thresh', 'RAW_IMG', 'proxy_RAW_IMG', 'dust_mask']
+        to_del = ['IMG', 'thresh', 'RAW_IMG', 'RAW_IMG_u8', 'RAW_IMG_gray', 'proxy_RAW_IMG', 'proxy_RAW_IMG_gray', 'dust_mask', 'view_IMG', 'view_sources']
         for attr in to_del:
             if hasattr(self, attr):
                 delattr(self, attr)
+        self.crop_cache = dict()
         self.processed = False
 
     def __sizeof__(self):
@@ -668,21 +821,56 @@ class RawProcessing:
         self.pick_wb = True # sets flag to measure and set white balance on next processing
         self.process()
     
+    def picker_mean(self, img, x, y, r):
+        # Returns the average colour of a small circle in img, without drawing a mask over the whole image
+        # x, y normalized between 0 and 1 as a proportion along the height and width of the rotated preview image
+        # r is the radius of the circle as a proportion of the size of the image
+        h, w = img.shape[:2]
+        rotation = self.rotation % 4
+        preview_h, preview_w = (w, h) if rotation % 2 else (h, w)
+        # applying scale factors based on image size
+        x = int(x * preview_w)
+        y = int(y * preview_h)
+        radius = int(min(h, w) * r)
+        # maps the point from the preview orientation back to the default orientation
+        if self.flip:
+            x = preview_w - 1 - x
+        match rotation:
+            case 1:
+                x, y = y, h - 1 - x
+            case 2:
+                x, y = w - 1 - x, h - 1 - y
+            case 3:
+                x, y = w - 1 - y, x
+        # only the bounding box of the circle is masked and averaged
+        x0, y0 = max(x - radius, 0), max(y - radius, 0)
+        x1, y1 = min(x + radius + 1, w), min(y + radius + 1, h)
+        mask = cv2.circle(np.zeros((y1 - y0, x1 - x0), np.uint8), (x - x0, y - y0), radius, 255, -1) # generate small circle to average pixels with
+        return cv2.mean(img[y0:y1, x0:x1], mask)
+
     def get_base_colour(self, x, y):
         # x, y normalized between 0 and 1 as a proportion along the image height and width
         # r is the radius of a small circle to measure the base colour as a proportion of the size of the image
-        base_mask = self.rotate(np.zeros_like(self.RAW_IMG[:,:,0], dtype=np.uint8)) # generate blank mask, rotate to same orientation as preview image
-        # applying scale factors based on image size
-        x = int(x * base_mask.shape[1])
-        y = int(y * base_mask.shape[0])
-        radius = int(min(base_mask.shape) * self.class_parameters['picker_radius'] / 100)
-
-        base_mask = cv2.circle(base_mask, (x, y), radius, 255, -1) # generate small circle to average pixels with
-        base_mask = self.rotate(base_mask, True) # rotate image back to default orientation
-        raw = cv2.convertScaleAbs(self.RAW_IMG, alpha=(255.0/65535.0))
-        meanBGR = cv2.mean(raw, base_mask)[:-1] # returns BGR tuple containing average of unmasked pixels
+        meanBGR = self.picker_mean(self.get_RAW_IMG_u8(), x, y, self.class_parameters['picker_radius'] / 100)[:-1] # returns BGR tuple containing average of the picked pixels
         self.base_rgb = tuple([round(x) for x in reversed(meanBGR)])
     
+    @staticmethod
+    def hist_percentile(channels, percentiles, mask=None, invert=False):
+        # Returns the percentiles of each channel, counted from its histogram instead of sorting the pixels
+        # channels: list of single channel 8 or 16-bit images, e.g. from cv2.split
+        # percentiles: sequence of percentiles, the result has one row per percentile and one column per channel
+        # invert: returns the percentiles of the inverted image, without having to invert it
+        values = np.empty((len(percentiles), len(channels)), np.float64)
+        for i, channel in enumerate(channels):
+            bins = 256 if channel.dtype == np.uint8 else 65536
+            hist = cv2.calcHist([channel], [0], mask, [bins], [0, bins])
+            if invert:
+                hist = hist[::-1]
+            cumulative = np.cumsum(hist, dtype=np.int64) # counts are accumulated as integers, float32 sums are not exact beyond 2^24 pixels
+            ranks = np.floor(np.array(percentiles) / 100 * (cumulative[-1] - 1)) # position of the percentiles in the sorted pixels
+            values[:, i] = np.searchsorted(cumulative, ranks, side='right')
+        return values
+
     @staticmethod
     def shrink_box(box, x, y):
         # given box with 4 corner coordinates, returns new box coordinates shrunken by x and y percentages
@@ -701,15 +889,11 @@ class RawProcessing:
         offset[ordered[:,1] > centre[1], 1] -= int(y_offset)
         offset[ordered[:,0] < centre[0], 0] += int(x_offset)
         offset[ordered[:,0] > centre[0], 0] -= int(x_offset)
-        for point in offset:
-            if point[0] > 0:
-                point[1] -= int(x_offset * skew)
-            else:
-                point[1] += int(x_offset * skew)
-            if point[1] < 0:
-                point[0] -= int(y_offset * skew)
-            else:
-                point[0] += int(y_offset * skew)
+        # skew correction, applied to all corners at once: the x offset's sign decides the y correction, then the corrected y offset's sign decides the x correction
+        x_skew = int(x_offset * skew)
+        y_skew = int(y_offset * skew)
+        offset[:,1] += np.where(offset[:,0] > 0, -x_skew, x_skew)
+        offset[:,0] += np.where(offset[:,1] < 0, -y_skew, y_skew)
         new_box = ordered + offset
         new_box = np.roll(new_box, index, axis=0)
         return new_box.astype(np.int32)